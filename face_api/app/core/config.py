@@ -1,3 +1,5 @@
+import os
+from functools import lru_cache, cached_property
 from pydantic_settings import BaseSettings
 from typing import Optional
 
@@ -20,11 +22,24 @@ class Settings(BaseSettings):
     # File Upload Configuration
     max_file_size: int = 10 * 1024 * 1024  # 10MB
     allowed_extensions: list = [".jpg", ".jpeg", ".png", ".bmp"]
+    upload_concurrency: int = min(32, (os.cpu_count() or 4) * 4)  # Parallel files per bulk request
+    web_concurrency: Optional[int] = None  # Uvicorn worker processes (python -m app.main defaults to cpu_count)
     
     # Face Detection Configuration
     similarity_threshold: float = 0.3
     face_model_name: str = "Facenet"  # Renamed to avoid conflict
+    face_mixed_precision: bool = True  # fp16 inference, only applied when a GPU is available
     
+    @cached_property
+    def allowed_exts_set(self) -> frozenset:
+        """Lower-cased allowed extensions for O(1) membership checks"""
+        return frozenset(ext.lower() for ext in self.allowed_extensions)
+
+    @property
+    def process_pool_size(self) -> int:
+        """Image worker processes per Uvicorn worker, so all workers together use each core once"""
+        return max(1, (os.cpu_count() or 1) // max(1, self.web_concurrency or 1))
+
     model_config = {
         "env_file": ".env",
         "case_sensitive": False,
@@ -32,4 +47,10 @@ class Settings(BaseSettings):
     }
 
 
-settings = Settings()
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Build the Settings once and reuse it (also usable as a FastAPI dependency)"""
+    return Settings()
+
+
+settings = get_settings()
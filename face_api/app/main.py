@@ -1,12 +1,16 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
+import asyncio
 import logging
+from contextlib import asynccontextmanager
 from datetime import datetime
 from app.core.config import settings
 from app.routers import upload, similarity
 from app.models.schemas import HealthCheckResponse
 from app.routers import upload, similarity, management
+from app.services.face_service import face_service
+from app.services.aws_service import aws_service
 
 # Configure logging
 logging.basicConfig(
@@ -15,12 +19,30 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Pre-warm the face model and the S3 connection pool, and own the image process pool"""
+    upload.get_process_pool()
+    try:
+        await asyncio.to_thread(face_service.warmup)
+    except Exception as e:
+        logger.warning("Face model warmup failed: %s", e)
+    try:
+        await asyncio.to_thread(aws_service.s3_client.head_bucket, Bucket=settings.aws_s3_bucket)
+    except Exception as e:
+        logger.warning("S3 warmup failed: %s", e)
+    yield
+    await asyncio.to_thread(upload.shutdown_process_pool)
+
+
 # Create FastAPI app
 app = FastAPI(
     title=settings.api_title,
     version=settings.api_version,
     description="Face Detection and Similarity Search API using DeepFace and AWS S3",
-    debug=settings.debug
+    debug=settings.debug,
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware
@@ -61,18 +83,27 @@ async def health_check():
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
     """Global exception handler"""
-    logger.error(f"Unhandled exception: {str(exc)}")
-    return JSONResponse(
+    logger.error("Unhandled exception: %s", exc, exc_info=exc)
+    return ORJSONResponse(
         status_code=500,
         content={"detail": "Internal server error"}
     )
 
 
 if __name__ == "__main__":
+    import os
     import uvicorn
+    # Reload mode only supports a single worker
+    workers = 1 if settings.debug else settings.web_concurrency or os.cpu_count() or 1
+    # Exported so each worker (a fresh process that re-reads Settings) sizes its
+    # image process pool from the same count, whether it came from .env or the environment
+    os.environ["WEB_CONCURRENCY"] = str(workers)
     uvicorn.run(
         "app.main:app",
         host="0.0.0.0",
         port=8000,
-        reload=settings.debug
+        reload=settings.debug,
+        workers=workers,
+        loop="uvloop",
+        http="httptools"
     )
\ No newline at end of file
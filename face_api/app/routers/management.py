@@ -53,5 +53,5 @@ async def delete_entire_folder(
             "s3_files_deleted": deleted_count
         }
     except Exception as e:
-        logger.error(f"Delete failed: {str(e)}")
+        logger.error("Delete failed: %s", e)
         raise HTTPException(status_code=500, detail=f"Delete failed: {str(e)}")
\ No newline at end of file
@@ -1,10 +1,12 @@
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends
 from typing import Optional # <--- Important
+import asyncio
+import os
 import time
 import logging
 from app.models.schemas import SearchResponse, FaceMatch
 from app.services.face_service import face_service
-from app.core.config import settings
+from app.core.config import Settings, get_settings
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/similarity", tags=["similarity"])
@@ -18,7 +20,8 @@ async def search_faces(
     # -----------------------------------
     
     limit: int = Form(5, description="Max matches to return"),
-    threshold: float = Form(0.40, description="Sensitivity (Lower is stricter)")
+    threshold: float = Form(0.40, description="Sensitivity (Lower is stricter)"),
+    settings: Settings = Depends(get_settings)
 ):
     """
     Search for a person.
@@ -26,24 +29,19 @@ async def search_faces(
     - Leave 'directory' empty to search entire database.
     """
     start_time = time.time()
-    temp_file_path = None
     
     try:
         # 1. Validation
         if not file.filename: raise HTTPException(status_code=400, detail="No filename")
-        file_extension = None
-        for ext in settings.allowed_extensions:
-            if file.filename.lower().endswith(ext):
-                file_extension = ext
-                break
-        if not file_extension: raise HTTPException(status_code=400, detail="Invalid file type")
+        file_extension = os.path.splitext(file.filename)[1].lower()
+        if file_extension not in settings.allowed_exts_set: raise HTTPException(status_code=400, detail="Invalid file type")
 
-        # 2. Process Image (Stream)
-        temp_file_path = await face_service.process_image_file(file.file, file_extension)
+        # 2. Decode Image (in memory, no temp file; off the event loop)
+        query_image = await asyncio.to_thread(face_service.decode_image_bytes, await file.read())
 
         # 3. Perform Search
         matches = await face_service.search_similar_faces(
-            query_image_path=temp_file_path, 
+            query_image=query_image, 
             directory_name=directory, # Can be None now
             threshold=threshold
         )
@@ -51,13 +49,13 @@ async def search_faces(
         # 4. Format Results
         formatted_matches = []
         for match in matches[:limit]:
-            formatted_matches.append(FaceMatch(
+            formatted_matches.append(FaceMatch.model_construct(
                 image_path=match[0],
                 s3_url=match[1],
                 similarity_score=float(match[2])
             ))
 
-        return SearchResponse(
+        return SearchResponse.model_construct(
             total_matches=len(formatted_matches),
             matches=formatted_matches,
             processing_time=time.time() - start_time,
@@ -65,15 +63,13 @@ async def search_faces(
         )
 
     except Exception as e:
-        logger.error(f"Search failed: {str(e)}")
-        return SearchResponse(
+        logger.error("Search failed: %s", e)
+        return SearchResponse.model_construct(
             total_matches=0, matches=[], processing_time=time.time() - start_time, error=str(e)
         )
         
     finally:
         await file.close()
-        if temp_file_path:
-            face_service.cleanup_temp_file(temp_file_path)
 
 @router.get("/stats")
 async def get_database_stats():
@@ -1,79 +1,158 @@
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
-from typing import List
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends
+from typing import List, Awaitable, Callable, TypeVar
 import time
 import asyncio
 import logging
 import os
-from rich.console import Console
-from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn, TimeElapsedColumn
+import sys
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
 from app.models.schemas import BulkUploadResponse, ImageUploadResponse
 from app.services.aws_service import aws_service
 from app.services.face_service import face_service
 from app.services.image_processing_service import image_processing_service
-from app.core.config import settings
+from app.core.config import Settings, get_settings
 
-console = Console()
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/upload", tags=["upload"])
 
-CONCURRENCY_LIMIT = 5 
 DEFAULT_WATERMARK_PATH = "app/assets/default_watermark.png"
 
+# Read the default watermark once instead of on every request
+if os.path.exists(DEFAULT_WATERMARK_PATH):
+    with open(DEFAULT_WATERMARK_PATH, "rb") as f: DEFAULT_WATERMARK_BYTES = f.read()
+else:
+    DEFAULT_WATERMARK_BYTES = None
+
+T = TypeVar("T")
+
+# --- HELPER: Bounded Concurrency ---
+async def run_bounded(files: List[UploadFile], handler: Callable[[UploadFile], Awaitable[T]], limit: int) -> List[T]:
+    """Run handler over files with at most `limit` in flight, results in input order.
+    A fixed set of workers pulls from a shared iterator, so no task ever waits on a semaphore."""
+    results: List[T] = [None] * len(files)
+    pending = iter(enumerate(files))
+
+    async def worker():
+        for index, file in pending:
+            results[index] = await handler(file)
+
+    await asyncio.gather(*(worker() for _ in range(min(limit, len(files)))))
+    return results
+
+# --- HELPER: Process Pool (Pillow work is CPU-bound, so keep it off the GIL) ---
+# Created and shut down by the app lifespan. Workers come from a forkserver: forking
+# this process (TF threads, the to_thread pool, an open SQLite connection) can deadlock.
+@lru_cache(maxsize=1)
+def get_process_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=get_settings().process_pool_size,
+        mp_context=multiprocessing.get_context("forkserver")
+    )
+
+def shutdown_process_pool():
+    if get_process_pool.cache_info().currsize:
+        get_process_pool().shutdown(cancel_futures=True)
+        get_process_pool.cache_clear()
+
+# --- HELPER: Console / Progress (rich is only imported when a request needs it) ---
+@lru_cache(maxsize=1)
+def get_console():
+    from rich.console import Console
+    return Console()
+
+# Nobody watches the progress bars when stdout is piped to a log file
+IS_TTY = sys.stdout.isatty()
+
+class NoopProgress:
+    """Drop-in for rich.Progress that does nothing (non-interactive deployments)"""
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+    def add_task(self, *args, **kwargs) -> int: return 0
+    def update(self, *args, **kwargs): pass
+    def advance(self, *args, **kwargs): pass
+
+def make_progress(show_percentage: bool = False):
+    if not IS_TTY: return NoopProgress()
+    rich_progress = importlib.import_module("rich.progress")
+    columns = [rich_progress.SpinnerColumn(), rich_progress.TextColumn("[bold blue]{task.description}"), rich_progress.BarColumn()]
+    if show_percentage:
+        columns.append(rich_progress.TextColumn("[progress.percentage]{task.percentage:>3.0f}%"))
+    return rich_progress.Progress(*columns, console=get_console(), refresh_per_second=2, transient=True)
+
 # --- HELPER: Get Watermark ---
 async def get_watermark_bytes(user_file: UploadFile | None) -> bytes | None:
     if user_file: return await user_file.read()
-    if os.path.exists(DEFAULT_WATERMARK_PATH):
-        with open(DEFAULT_WATERMARK_PATH, "rb") as f: return f.read()
-    return None
+    return DEFAULT_WATERMARK_BYTES
+
+# --- HELPER: Save Embedding (now, or queued for one batched insert) ---
+async def save_embedding(s3_url: str, embedding, records: list | None) -> bool:
+    if records is None:
+        return await face_service.store_embedding_record(s3_url, embedding)
+    records.append((s3_url, embedding))
+    return True
+
+async def flush_embeddings(records: list, results: List[ImageUploadResponse]):
+    """Insert the queued embeddings of a bulk request with one executemany."""
+    if await face_service.store_embedding_records(records): return
+    failed_urls = {s3_url for s3_url, _ in records}
+    for result in results:
+        if result.s3_url in failed_urls: result.embedding_stored = False
 
 # --- HELPER: Process Standard File (With Compress + Watermark) ---
-async def process_standard_file(file: UploadFile, watermark_bytes, directory, progress, overall_task):
+async def process_standard_file(file: UploadFile, watermark_bytes, directory, settings: Settings, progress, overall_task, records: list | None = None):
     task_id = progress.add_task(f"Waiting...", total=4, visible=False)
     try:
         progress.update(task_id, visible=True, description=f"🔄 Processing: {file.filename}")
         
         if not file.filename: raise Exception("No filename")
-        file_extension = None
-        for ext in settings.allowed_extensions:
-            if file.filename.lower().endswith(ext):
-                file_extension = ext; break
-        if not file_extension: raise Exception("Invalid file type")
+        file_extension = os.path.splitext(file.filename)[1].lower()
+        if file_extension not in settings.allowed_exts_set: raise Exception("Invalid file type")
         
         progress.update(task_id, advance=1)
 
         # 1. Process Image (Compress + Watermark)
-        loop = asyncio.get_event_loop()
+        # Read into bytes first: file objects can't be pickled into the worker process
+        content = await file.read()
+        loop = asyncio.get_running_loop()
         processed_content = await loop.run_in_executor(
-            None, image_processing_service.process_image, file.file, watermark_bytes
+            get_process_pool(), image_processing_service.process_image, content, watermark_bytes
         )
         final_extension = ".jpg" # Standard uploads become JPG
         
-        progress.update(task_id, advance=1, description=f"☁️ Uploading...")
+        progress.update(task_id, advance=1, description="☁️ Uploading + 👤 Detecting Face...")
         
-        # 2. Upload
-        s3_url = await aws_service.upload_file(processed_content, final_extension, folder_path=directory)
+        # 2. Upload and Detect in parallel (network wait overlaps model inference)
+        upload_task = asyncio.create_task(aws_service.upload_file(processed_content, final_extension, folder_path=directory))
+        embed_task = asyncio.create_task(asyncio.to_thread(face_service.embed_from_bytes, processed_content))
+        s3_url, embedding = await asyncio.gather(upload_task, embed_task, return_exceptions=True)
+        if isinstance(s3_url, BaseException): raise s3_url
         
-        progress.update(task_id, advance=1, description=f"👤 Detecting Face...")
+        progress.update(task_id, advance=1, description="💾 Saving Embedding...")
         
-        # 3. Detect
-        temp_file_path = await face_service.process_image_file(processed_content, final_extension)
-        embedding_stored = await face_service.store_embedding(temp_file_path, s3_url)
-        face_service.cleanup_temp_file(temp_file_path)
+        # 3. Store the embedding once the S3 URL is known
+        if isinstance(embedding, BaseException):
+            logger.error("Failed to compute embedding: %s", embedding)
+            embedding_stored = False
+        else:
+            embedding_stored = await save_embedding(s3_url, embedding, records)
         
         progress.update(task_id, advance=1, visible=False)
         progress.advance(overall_task)
         
-        return ImageUploadResponse(filename=file.filename, s3_url=s3_url, processed=True, embedding_stored=embedding_stored, error=None)
+        return ImageUploadResponse.model_construct(filename=file.filename, s3_url=s3_url, processed=True, embedding_stored=embedding_stored, error=None)
     except Exception as e:
         progress.update(task_id, visible=False)
         progress.advance(overall_task)
-        return ImageUploadResponse(filename=file.filename, s3_url="", processed=False, embedding_stored=False, error=str(e))
+        return ImageUploadResponse.model_construct(filename=file.filename, s3_url="", processed=False, embedding_stored=False, error=str(e))
     finally:
         await file.close()
 
 # --- HELPER: Process Original File (NO Compress, NO Watermark) ---
-async def process_original_file(file: UploadFile, directory, progress, overall_task):
+async def process_original_file(file: UploadFile, directory, settings: Settings, progress, overall_task, records: list | None = None):
     task_id = progress.add_task(f"Waiting...", total=3, visible=False)
     try:
         progress.update(task_id, visible=True, description=f"🔄 Reading: {file.filename}")
@@ -81,33 +160,38 @@ async def process_original_file(file: UploadFile, directory, progress, overall_t
         if not file.filename: raise Exception("No filename")
         # Extract extension
         file_extension = os.path.splitext(file.filename)[1].lower()
-        if file_extension not in settings.allowed_extensions: raise Exception("Invalid file type")
+        if file_extension not in settings.allowed_exts_set: raise Exception("Invalid file type")
         
-        progress.update(task_id, advance=1, description=f"☁️ Uploading Original...")
+        progress.update(task_id, advance=1, description="☁️ Uploading Original...")
         
         # 1. Upload Stream DIRECTLY to AWS (Supports 100MB+)
-        # We use file.file which is the stream
+        # We use file.file which is the stream (multipart, one part in memory at a time)
         s3_url = await aws_service.upload_file(file.file, file_extension, folder_path=directory)
         
-        progress.update(task_id, advance=1, description=f"👤 Detecting Face...")
+        progress.update(task_id, advance=1, description="👤 Detecting Face...")
         
-        # 2. Reset stream to start for Face Detection
-        file.file.seek(0) 
+        # 2. Reset stream to start for Face Detection (upload_file leaves it open)
+        await file.seek(0)
         
-        # 3. Detect
-        temp_file_path = await face_service.process_image_file(file.file, file_extension)
-        embedding_stored = await face_service.store_embedding(temp_file_path, s3_url)
-        face_service.cleanup_temp_file(temp_file_path)
+        # 3. Detect (decode in memory, no temp file)
+        content = await file.read()
+        try:
+            embedding = await asyncio.to_thread(face_service.embed_from_bytes, content)
+        except Exception as e:
+            logger.error("Failed to compute embedding: %s", e)
+            embedding_stored = False
+        else:
+            embedding_stored = await save_embedding(s3_url, embedding, records)
         
         progress.update(task_id, advance=1, visible=False)
         progress.advance(overall_task)
         
-        return ImageUploadResponse(filename=file.filename, s3_url=s3_url, processed=False, embedding_stored=embedding_stored, error=None)
+        return ImageUploadResponse.model_construct(filename=file.filename, s3_url=s3_url, processed=False, embedding_stored=embedding_stored, error=None)
     except Exception as e:
         progress.update(task_id, visible=False)
         progress.advance(overall_task)
-        console.print(f"[red]Failed {file.filename}: {e}[/red]")
-        return ImageUploadResponse(filename=file.filename, s3_url="", processed=False, embedding_stored=False, error=str(e))
+        get_console().print(f"[red]Failed {file.filename}: {e}[/red]")
+        return ImageUploadResponse.model_construct(filename=file.filename, s3_url="", processed=False, embedding_stored=False, error=str(e))
     finally:
         await file.close()
 
@@ -117,33 +201,36 @@ async def process_original_file(file: UploadFile, directory, progress, overall_t
 async def upload_single_image(
     file: UploadFile = File(..., description="Select an image"),
     watermark_file: UploadFile = File(None, description="Upload a logo image (optional)"),
-    directory: str = Form("face-images")
+    directory: str = Form("face-images"),
+    settings: Settings = Depends(get_settings)
 ):
     watermark_bytes = await get_watermark_bytes(watermark_file)
-    with Progress(SpinnerColumn(), TextColumn("[bold blue]{task.description}"), BarColumn(), console=console) as progress:
+    with make_progress() as progress:
         task = progress.add_task("Single Upload", total=1)
-        return await process_standard_file(file, watermark_bytes, directory, progress, task)
+        return await process_standard_file(file, watermark_bytes, directory, settings, progress, task)
 
 @router.post("/bulk", response_model=BulkUploadResponse)
 async def bulk_upload_images(
     files: List[UploadFile] = File(..., description="Select multiple images"),
     watermark_file: UploadFile = File(None, description="Upload a logo image (optional)"),
-    directory: str = Form("face-images")
+    directory: str = Form("face-images"),
+    settings: Settings = Depends(get_settings)
 ):
     start_time = time.time()
     watermark_bytes = await get_watermark_bytes(watermark_file)
-    semaphore = asyncio.Semaphore(CONCURRENCY_LIMIT)
 
-    async def sem_task(file):
-        async with semaphore: return await process_standard_file(file, watermark_bytes, directory, progress, overall_task)
+    records = []
 
-    with Progress(SpinnerColumn(), TextColumn("[bold blue]{task.description}"), BarColumn(), TextColumn("[progress.percentage]{task.percentage:>3.0f}%"), console=console) as progress:
+    async def handle(file):
+        return await process_standard_file(file, watermark_bytes, directory, settings, progress, overall_task, records)
+
+    with make_progress(show_percentage=True) as progress:
         overall_task = progress.add_task(f"[green]Batch Processing...", total=len(files))
-        tasks = [sem_task(file) for file in files]
-        results = await asyncio.gather(*tasks)
+        results = await run_bounded(files, handle, settings.upload_concurrency)
+    await flush_embeddings(records, results)
 
     successful = sum(1 for r in results if r.embedding_stored)
-    return BulkUploadResponse(total_files=len(files), successful_uploads=successful, failed_uploads=len(results)-successful, results=results, processing_time=time.time()-start_time)
+    return BulkUploadResponse.model_construct(total_files=len(files), successful_uploads=successful, failed_uploads=len(results)-successful, results=results, processing_time=time.time()-start_time)
 
 
 # ===================== ORIGINAL ENDPOINTS (No Compress, No Watermark) =====================
@@ -151,27 +238,30 @@ async def bulk_upload_images(
 @router.post("/original/single", response_model=ImageUploadResponse)
 async def upload_original_single(
     file: UploadFile = File(..., description="Select an image (Original Quality, No Compression)"),
-    directory: str = Form("face-images")
+    directory: str = Form("face-images"),
+    settings: Settings = Depends(get_settings)
 ):
-    with Progress(SpinnerColumn(), TextColumn("[bold blue]{task.description}"), BarColumn(), console=console) as progress:
+    with make_progress() as progress:
         task = progress.add_task("Single Original Upload", total=1)
-        return await process_original_file(file, directory, progress, task)
+        return await process_original_file(file, directory, settings, progress, task)
 
 @router.post("/original/bulk", response_model=BulkUploadResponse)
 async def upload_original_bulk(
     files: List[UploadFile] = File(..., description="Select multiple images (Original Quality)"),
-    directory: str = Form("face-images")
+    directory: str = Form("face-images"),
+    settings: Settings = Depends(get_settings)
 ):
     start_time = time.time()
-    semaphore = asyncio.Semaphore(CONCURRENCY_LIMIT)
 
-    async def sem_task(file):
-        async with semaphore: return await process_original_file(file, directory, progress, overall_task)
+    records = []
+
+    async def handle(file):
+        return await process_original_file(file, directory, settings, progress, overall_task, records)
 
-    with Progress(SpinnerColumn(), TextColumn("[bold blue]{task.description}"), BarColumn(), TextColumn("[progress.percentage]{task.percentage:>3.0f}%"), console=console) as progress:
+    with make_progress(show_percentage=True) as progress:
         overall_task = progress.add_task(f"[green]Original Batch...", total=len(files))
-        tasks = [sem_task(file) for file in files]
-        results = await asyncio.gather(*tasks)
+        results = await run_bounded(files, handle, settings.upload_concurrency)
+    await flush_embeddings(records, results)
 
     successful = sum(1 for r in results if r.embedding_stored)
-    return BulkUploadResponse(total_files=len(files), successful_uploads=successful, failed_uploads=len(results)-successful, results=results, processing_time=time.time()-start_time)
\ No newline at end of file
+    return BulkUploadResponse.model_construct(total_files=len(files), successful_uploads=successful, failed_uploads=len(results)-successful, results=results, processing_time=time.time()-start_time)
\ No newline at end of file
@@ -1,93 +1,184 @@
-import boto3
+import asyncio
+import hashlib
 import uuid
-from typing import Optional, List, Dict, BinaryIO
+from functools import cached_property
+from typing import Optional, List, Dict, BinaryIO, AsyncIterator
 from fastapi import HTTPException
 from app.core.config import settings
 import logging
 
 logger = logging.getLogger(__name__)
 
+# S3 DeleteObjects accepts at most 1000 keys per request
+S3_DELETE_BATCH_SIZE = 1000
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB
+
+class NonClosingStream:
+    """
+    Proxy for a caller's stream whose close() is a no-op.
+    s3transfer closes the file object it uploads (below the multipart threshold),
+    but callers rewind and reuse the stream afterwards.
+    """
+    def __init__(self, stream: BinaryIO):
+        self._stream = stream
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+    def close(self): pass
+
 class AWSService:
     def __init__(self):
-        self.s3_client = boto3.client(
+        self.bucket_name = settings.aws_s3_bucket
+        self._url_prefix = f"https://{self.bucket_name}.s3.{settings.region}.amazonaws.com/"
+
+    @cached_property
+    def s3_client(self):
+        """Create the boto3 client on first use to keep app startup cheap"""
+        import boto3
+        return boto3.client(
             's3',
             aws_access_key_id=settings.aws_id,
             aws_secret_access_key=settings.aws_secret,
             region_name=settings.region
         )
-        self.bucket_name = settings.aws_s3_bucket
+
+    @cached_property
+    def transfer_config(self):
+        """Multipart settings for streamed uploads (large originals)"""
+        from boto3.s3.transfer import TransferConfig
+        return TransferConfig(
+            multipart_threshold=MULTIPART_CHUNK_SIZE,
+            multipart_chunksize=MULTIPART_CHUNK_SIZE,
+            max_concurrency=4,
+            use_threads=True
+        )
 
     # --- CHANGED: Accepts bytes OR BinaryIO (Stream) for large files ---
     async def upload_file(self, file_content: bytes | BinaryIO, file_extension: str, folder_path: str = "face-images") -> str:
         """Upload file (or stream) to S3 in a specific folder"""
         try:
-            filename = f"{uuid.uuid4()}{file_extension}"
             clean_folder = folder_path.strip("/")
-            s3_key = f"{clean_folder}/{filename}"
+            content_type = f"image/{file_extension[1:]}"
+            if isinstance(file_content, bytes):
+                # Content-addressed key: re-uploading the same bytes (e.g. a retried batch) is a no-op
+                filename = hashlib.blake2b(file_content, digest_size=16).hexdigest() + file_extension
+                s3_key = clean_folder + "/" + filename
+                if await asyncio.to_thread(self._object_exists, s3_key):
+                    s3_url = self._url_prefix + s3_key
+                    logger.info("File already in S3, skipping upload: %s", s3_url)
+                    return s3_url
+                await asyncio.to_thread(
+                    self.s3_client.put_object,
+                    Bucket=self.bucket_name,
+                    Key=s3_key,
+                    Body=file_content,
+                    ContentType=content_type
+                )
+            else:
+                filename = uuid.uuid4().hex + file_extension
+                s3_key = clean_folder + "/" + filename
+                # Streams go through the managed transfer: parallel multipart parts,
+                # only one part held in memory at a time
+                await asyncio.to_thread(
+                    self.s3_client.upload_fileobj,
+                    NonClosingStream(file_content),
+                    self.bucket_name,
+                    s3_key,
+                    ExtraArgs={'ContentType': content_type},
+                    Config=self.transfer_config
+                )
             
-            # boto3 'Body' accepts bytes or a read()able file-like object (Stream)
-            self.s3_client.put_object(
-                Bucket=self.bucket_name,
-                Key=s3_key,
-                Body=file_content, 
-                ContentType=f"image/{file_extension[1:]}"
-            )
-            
-            s3_url = f"https://{self.bucket_name}.s3.{settings.region}.amazonaws.com/{s3_key}"
-            logger.info(f"Successfully uploaded file to S3: {s3_url}")
+            s3_url = self._url_prefix + s3_key
+            logger.info("Successfully uploaded file to S3: %s", s3_url)
             return s3_url
             
         except Exception as e:
-            logger.error(f"Failed to upload file to S3: {str(e)}")
+            logger.error("Failed to upload file to S3: %s", e)
             raise HTTPException(status_code=500, detail=f"Failed to upload file: {str(e)}")
 
+    def _object_exists(self, s3_key: str) -> bool:
+        """HeadObject check. Any client error (404, or 403 without ListBucket) counts as missing."""
+        from botocore.exceptions import ClientError
+        try:
+            self.s3_client.head_object(Bucket=self.bucket_name, Key=s3_key)
+            return True
+        except ClientError:
+            return False
+
+    def _delete_chunk(self, keys: List[str]) -> int:
+        """Delete up to 1000 keys in one request, returns number deleted."""
+        response = self.s3_client.delete_objects(
+            Bucket=self.bucket_name,
+            Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+        )
+        # In quiet mode S3 only reports the failures
+        return len(keys) - len(response.get('Errors', []))
+
+    async def _delete_keys(self, s3_keys: List[str]) -> int:
+        """Split keys into 1000-key chunks and delete them concurrently."""
+        chunks = [s3_keys[i:i + S3_DELETE_BATCH_SIZE] for i in range(0, len(s3_keys), S3_DELETE_BATCH_SIZE)]
+        results = await asyncio.gather(*(asyncio.to_thread(self._delete_chunk, chunk) for chunk in chunks))
+        return sum(results)
+
     async def delete_multiple_files(self, s3_keys: List[str]) -> int:
         """Delete a list of specific files from S3."""
         try:
             if not s3_keys: return 0
-            objects_to_delete = [{'Key': key} for key in s3_keys]
-            self.s3_client.delete_objects(Bucket=self.bucket_name, Delete={'Objects': objects_to_delete})
-            logger.info(f"Deleted {len(objects_to_delete)} files from S3")
-            return len(objects_to_delete)
+            deleted_count = await self._delete_keys(s3_keys)
+            logger.info("Deleted %s files from S3", deleted_count)
+            return deleted_count
         except Exception as e:
-            logger.error(f"Failed to delete files from S3: {str(e)}")
+            logger.error("Failed to delete files from S3: %s", e)
             return 0
 
+    async def _iter_pages(self, prefix: str) -> AsyncIterator[List[Dict]]:
+        """Yield the 'Contents' of every list_objects_v2 page under a prefix (no 1000-object cap)."""
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        pages = iter(paginator.paginate(Bucket=self.bucket_name, Prefix=prefix, PaginationConfig={'PageSize': 1000}))
+        while True:
+            # Each page is a blocking HTTP request, fetch it off the event loop
+            page = await asyncio.to_thread(next, pages, None)
+            if page is None: break
+            yield page.get('Contents', [])
+
     async def list_files_in_folder(self, folder_path: str) -> List[Dict[str, str]]:
         """List all files inside a specific S3 folder (Requires ListBucket permission)."""
         try:
             clean_prefix = folder_path.strip("/") + "/"
-            response = self.s3_client.list_objects_v2(Bucket=self.bucket_name, Prefix=clean_prefix)
-            if 'Contents' not in response: return []
             files = []
-            for obj in response['Contents']:
-                key = obj['Key']
-                if key == clean_prefix: continue
-                url = f"https://{self.bucket_name}.s3.{settings.region}.amazonaws.com/{key}"
-                files.append({
-                    "filename": key.split("/")[-1],
-                    "full_path": key,
-                    "s3_url": url,
-                    "size": obj['Size']
-                })
+            async for contents in self._iter_pages(clean_prefix):
+                for obj in contents:
+                    key = obj['Key']
+                    if key == clean_prefix: continue
+                    url = self._url_prefix + key
+                    files.append({
+                        "filename": key.split("/")[-1],
+                        "full_path": key,
+                        "s3_url": url,
+                        "size": obj['Size']
+                    })
             return files
         except Exception as e:
-            logger.error(f"Failed to list files: {str(e)}")
+            logger.error("Failed to list files: %s", e)
             raise HTTPException(status_code=500, detail=f"Failed to list files: {str(e)}")
 
     async def delete_folder(self, folder_path: str) -> int:
         """Delete all files inside a folder (Requires ListBucket permission)."""
         try:
             clean_prefix = folder_path.strip("/") + "/"
-            response = self.s3_client.list_objects_v2(Bucket=self.bucket_name, Prefix=clean_prefix)
-            if 'Contents' not in response: return 0
-            objects_to_delete = [{'Key': obj['Key']} for obj in response['Contents']]
-            if objects_to_delete:
-                self.s3_client.delete_objects(Bucket=self.bucket_name, Delete={'Objects': objects_to_delete})
-                return len(objects_to_delete)
-            return 0
+            # Start deleting each page as soon as it is listed
+            delete_tasks = []
+            async for contents in self._iter_pages(clean_prefix):
+                keys_to_delete = [obj['Key'] for obj in contents]
+                if keys_to_delete:
+                    delete_tasks.append(asyncio.create_task(self._delete_keys(keys_to_delete)))
+            if not delete_tasks: return 0
+            return sum(await asyncio.gather(*delete_tasks))
         except Exception as e:
-            logger.error(f"Failed to delete folder: {str(e)}")
+            logger.error("Failed to delete folder: %s", e)
             raise HTTPException(status_code=500, detail=f"Failed to delete folder: {str(e)}")
 
 aws_service = AWSService()
\ No newline at end of file
@@ -0,0 +1,144 @@
+import numpy as np
+from collections import Counter
+from typing import List, Dict, Optional, Iterable, Tuple
+
+# Matrix capacity grows in chunks of this many rows so appends are amortized O(1)
+GROW_CHUNK = 1024
+
+
+def directory_matches(directory: str, name: str) -> bool:
+    """
+    Whether a folder filter selects a stored directory, with the same meaning the
+    `s3_url LIKE '%/name/%'` filter always had: `name` is any run of whole path segments
+    (so 'try' matches 'face-images/try', and a folder matches its subfolders),
+    ASCII case-insensitive like LIKE.
+    """
+    return f"/{name}/".lower() in f"/{directory}/".lower()
+
+
+class EmbeddingIndex:
+    """
+    In-memory copy of the faces table for search.
+    - Rows are L2-normalized embeddings in one pre-allocated matrix of `dtype`
+      (float32, or int8 when scored with SimSIMD's int8 kernel).
+    - `blob_dtype` is how the source column stores each vector (float16 or int8).
+    - New rows are appended; deleted/replaced rows are tombstoned via the `alive` mask.
+    """
+    def __init__(self, blob_dtype=np.float16, dtype=np.float32):
+        self.blob_dtype = np.dtype(blob_dtype)
+        self.dtype = np.dtype(dtype)
+        self.clear()
+
+    def clear(self):
+        self.loaded = False
+        self.matrix: Optional[np.ndarray] = None
+        self.size = 0
+        self.live_count = 0
+        self.skipped = 0  # rows present in the table but left out (embedding size mismatch)
+        self.max_id = 0
+        self.alive = np.zeros(0, dtype=bool)
+        self.paths: List[str] = []
+        self.urls: List[str] = []
+        self.directories: List[str] = []
+        self._row_of_path: Dict[str, int] = {}
+        self._dir_rows: Dict[str, np.ndarray] = {}
+
+    @property
+    def dim(self) -> Optional[int]:
+        return None if self.matrix is None else self.matrix.shape[1]
+
+    def load(self, rows: List[Tuple[int, str, str, str, bytes]]) -> None:
+        """Replace the whole index with (id, image_path, s3_url, directory, embedding blob) rows."""
+        self.clear()
+        self.loaded = True
+        if not rows:
+            return
+        # Skip rows whose embedding size doesn't match the rest (e.g. written by another model)
+        blob_size = Counter(len(row[4]) for row in rows).most_common(1)[0][0]
+        self.max_id = max(row[0] for row in rows)
+        matching = [row for row in rows if len(row[4]) == blob_size]
+        self.skipped = len(rows) - len(matching)
+        rows = matching
+
+        # Copy the blobs straight into one pre-allocated matrix: no per-row arrays and
+        # no intermediate joined bytes object
+        blobs = np.empty((len(rows), blob_size // self.blob_dtype.itemsize), dtype=self.blob_dtype)
+        buffer = blobs.reshape(-1).view(np.uint8).data
+        for i, row in enumerate(rows):
+            buffer[i * blob_size:(i + 1) * blob_size] = row[4]
+
+        capacity = -(-len(rows) // GROW_CHUNK) * GROW_CHUNK
+        self.matrix = np.empty((capacity, blobs.shape[1]), dtype=self.dtype)
+        self.matrix[:len(rows)] = blobs
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.alive[:len(rows)] = True
+        for i, (_, path, url, directory, _) in enumerate(rows):
+            self.paths.append(path)
+            self.urls.append(url)
+            self.directories.append(directory)
+            self._row_of_path[path] = i
+        self.size = self.live_count = len(rows)
+
+    def append(self, row_id: int, image_path: str, s3_url: str, directory: str, embedding: np.ndarray) -> None:
+        """Add one embedding (decoded from its blob); a row with the same image_path is replaced (INSERT OR REPLACE)."""
+        embedding = np.asarray(embedding, dtype=self.dtype)
+        self.max_id = max(self.max_id, row_id)
+        if self.matrix is None:
+            self.matrix = np.empty((GROW_CHUNK, embedding.shape[0]), dtype=self.dtype)
+            self.alive = np.zeros(GROW_CHUNK, dtype=bool)
+        elif embedding.shape[0] != self.dim:
+            self.skipped += 1
+            return
+        elif self.size == self.matrix.shape[0]:
+            self.matrix = np.concatenate([self.matrix, np.empty((GROW_CHUNK, self.dim), dtype=self.dtype)])
+            self.alive = np.concatenate([self.alive, np.zeros(GROW_CHUNK, dtype=bool)])
+
+        old_row = self._row_of_path.get(image_path)
+        if old_row is not None:
+            self._kill(old_row)
+
+        self.matrix[self.size] = embedding
+        self.alive[self.size] = True
+        self.paths.append(image_path)
+        self.urls.append(s3_url)
+        self.directories.append(directory)
+        self._row_of_path[image_path] = self.size
+        self.size += 1
+        self.live_count += 1
+        self._dir_rows.clear()
+
+    def remove_urls(self, s3_urls: Iterable[str]) -> None:
+        """Tombstone every live row pointing at one of these URLs."""
+        targets = set(s3_urls)
+        for row in np.flatnonzero(self.alive[:self.size]):
+            if self.urls[row] in targets:
+                self._kill(row)
+        self._dir_rows.clear()
+
+    def _kill(self, row: int) -> None:
+        if self.alive[row]:
+            self.alive[row] = False
+            self.live_count -= 1
+            if self._row_of_path.get(self.paths[row]) == row:
+                del self._row_of_path[self.paths[row]]
+
+    def candidate_rows(self, directory_name: Optional[str]) -> Optional[np.ndarray]:
+        """
+        Row indices to score, or None meaning "all of matrix[:size]".
+        Folder matching is the same directory_matches test as the SQL side.
+        """
+        if not directory_name:
+            if self.live_count == self.size:
+                return None
+            return np.flatnonzero(self.alive[:self.size])
+
+        rows = self._dir_rows.get(directory_name)
+        if rows is None:
+            # Test each distinct directory once, then pick its rows
+            matching = {d for d in set(self.directories) if directory_matches(d, directory_name)}
+            rows = np.array(
+                [i for i in np.flatnonzero(self.alive[:self.size]) if self.directories[i] in matching],
+                dtype=np.intp
+            )
+            self._dir_rows[directory_name] = rows
+        return rows
@@ -1,78 +1,216 @@
+import asyncio
 import sqlite3
+import threading
+from contextlib import closing, contextmanager
 import numpy as np
-import tempfile
-import os
-import shutil
-from typing import List, Tuple, BinaryIO, Dict
-from deepface import DeepFace
-from scipy.spatial.distance import cosine
+from typing import List, Tuple, Dict, Iterator
 from fastapi import HTTPException
 import logging
 from app.core.config import settings
+from app.services.embedding_index import EmbeddingIndex, directory_matches
 
 logger = logging.getLogger(__name__)
 
+# SimSIMD computes dot and both norms in one fused SIMD pass (float32 and int8); numpy is the fallback
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
+
+
+def normalized_f16_bytes(embedding: np.ndarray) -> bytes:
+    """L2-normalize an embedding and serialize it as float16 (cosine becomes a plain dot product)."""
+    embedding = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(embedding)
+    if norm:
+        embedding = embedding / norm
+    return embedding.astype(np.float16).tobytes()
+
+
+def quantize_i8(embedding: np.ndarray) -> np.ndarray:
+    """Symmetric int8 quantization scaled by the largest component (cosine is scale-invariant)."""
+    embedding = np.asarray(embedding, dtype=np.float32)
+    peak = np.abs(embedding).max() if embedding.size else 0
+    if not peak:
+        return np.zeros(embedding.shape, dtype=np.int8)
+    return np.round(embedding * (127 / peak)).astype(np.int8)
+
+
+def s3_key_of(s3_url: str) -> str:
+    """S3 key of an object URL (the whole string when it isn't an S3 URL)."""
+    _, marker, key = s3_url.rpartition("amazonaws.com/")
+    return key if marker else s3_url
+
+
+def directory_of(s3_url: str) -> str:
+    """Folder part of the S3 key, e.g. '.../class-10/abc.jpg' -> 'class-10'."""
+    return s3_key_of(s3_url).rpartition("/")[0]
+
+
+def cosine_similarities(matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Cosine similarity of query against every row of matrix."""
+    if simsimd is not None:
+        return 1 - np.asarray(simsimd.cdist(query[None, :], matrix, metric="cosine"), dtype=np.float32)[0]
+    # Rows and query are L2-normalized, so the dot product is the cosine
+    return matrix @ query
+
+
+def rank_matches(matrix: np.ndarray, rows: np.ndarray | None, query: np.ndarray, threshold: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Row indices and similarities of candidates within the distance threshold, best first."""
+    if matrix.shape[0] == 0:
+        # Empty/cleared folder (SimSIMD rejects empty collections)
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+    sims = cosine_similarities(matrix, query)
+    hits = np.flatnonzero(sims > 1 - threshold)
+    hits = hits[np.argsort(-sims[hits])]
+    return (hits if rows is None else rows[hits]), sims[hits]
+
+
 class FaceService:
     def __init__(self):
         self.db_path = "faces.db"
+        # One long-lived connection shared by all requests; the lock serializes access to it
+        # (and to the search index below)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._lock = threading.Lock()
         self._init_database()
+        # In-memory search index, kept in sync incrementally (see _refresh_index).
+        # With SimSIMD, search runs on int8 vectors (4x less memory, int8 dot-product kernels);
+        # without it, on float32 restored from the normalized float16 column.
+        if simsimd is not None:
+            self._index_column = "embedding_i8"
+            self._index = EmbeddingIndex(blob_dtype=np.int8, dtype=np.int8)
+        else:
+            self._index_column = "embedding_f16"
+            self._index = EmbeddingIndex(blob_dtype=np.float16, dtype=np.float32)
+        # PRAGMA data_version seen at the last sync (it only moves on other connections' commits),
+        # and whether this connection wrote rows the index hasn't picked up yet
+        self._data_version = None
+        self._index_stale = True
 
     def _init_database(self):
         try:
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
-            c.execute("""
-                CREATE TABLE IF NOT EXISTS faces (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    image_path TEXT UNIQUE,
-                    s3_url TEXT,
-                    embedding BLOB,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            conn.commit()
-            conn.close()
+            # PRAGMAs and DDL run before the transaction opens (sqlite3 only begins one for DML)
+            with self._cursor() as c, self._conn:
+                self._create_schema(c)
         except Exception as e:
-            logger.error(f"Failed to initialize database: {str(e)}")
+            logger.error("Failed to initialize database: %s", e)
             raise HTTPException(status_code=500, detail="Database initialization failed")
 
+    def _create_schema(self, c: sqlite3.Cursor) -> None:
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+        c.execute("PRAGMA mmap_size=268435456")
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS faces (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                image_path TEXT UNIQUE,
+                s3_url TEXT,
+                embedding BLOB,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        self._migrate_embedding_f16(c)
+        self._migrate_embedding_i8(c)
+        self._migrate_directory(c)
+
+    def _migrate_embedding_f16(self, c: sqlite3.Cursor) -> None:
+        """Add the pre-normalized float16 column and backfill it for rows stored before it existed."""
+        columns = {row[1] for row in c.execute("PRAGMA table_info(faces)")}
+        if "embedding_f16" not in columns:
+            c.execute("ALTER TABLE faces ADD COLUMN embedding_f16 BLOB")
+        c.execute("SELECT id, embedding FROM faces WHERE embedding_f16 IS NULL")
+        updates = [(normalized_f16_bytes(np.frombuffer(blob, dtype=np.float32)), row_id) for row_id, blob in c.fetchall()]
+        if updates:
+            c.executemany("UPDATE faces SET embedding_f16 = ? WHERE id = ?", updates)
+            logger.info("Backfilled embedding_f16 for %s faces", len(updates))
+
+    def _migrate_embedding_i8(self, c: sqlite3.Cursor) -> None:
+        """Add the int8-quantized column and backfill it for rows stored before it existed."""
+        columns = {row[1] for row in c.execute("PRAGMA table_info(faces)")}
+        if "embedding_i8" not in columns:
+            c.execute("ALTER TABLE faces ADD COLUMN embedding_i8 BLOB")
+        c.execute("SELECT id, embedding FROM faces WHERE embedding_i8 IS NULL")
+        updates = [(quantize_i8(np.frombuffer(blob, dtype=np.float32)).tobytes(), row_id) for row_id, blob in c.fetchall()]
+        if updates:
+            c.executemany("UPDATE faces SET embedding_i8 = ? WHERE id = ?", updates)
+            logger.info("Backfilled embedding_i8 for %s faces", len(updates))
+
+    def _migrate_directory(self, c: sqlite3.Cursor) -> None:
+        """Add the indexed directory column (folder part of the S3 key) and backfill it."""
+        columns = {row[1] for row in c.execute("PRAGMA table_info(faces)")}
+        if "directory" not in columns:
+            c.execute("ALTER TABLE faces ADD COLUMN directory TEXT")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_faces_directory ON faces (directory)")
+        c.execute("SELECT id, s3_url FROM faces WHERE directory IS NULL")
+        updates = [(directory_of(s3_url), row_id) for row_id, s3_url in c.fetchall()]
+        if updates:
+            c.executemany("UPDATE faces SET directory = ? WHERE id = ?", updates)
+            logger.info("Backfilled directory for %s faces", len(updates))
+
+    def _configure_tensorflow(self):
+        """Let TF grow GPU memory on demand and run inference in float16 when a GPU is present."""
+        try:
+            import tensorflow as tf
+        except ImportError:
+            return
+        gpus = tf.config.list_physical_devices("GPU")
+        for gpu in gpus:
+            tf.config.experimental.set_memory_growth(gpu, True)
+        if gpus and settings.face_mixed_precision:
+            # Must be set before the model is built; Keras casts inputs to the policy's compute dtype
+            tf.keras.mixed_precision.set_global_policy("mixed_float16")
+            logger.info("Using mixed_float16 on %s GPU(s)", len(gpus))
+
+    def warmup(self):
+        """Load the face model once and run one embedding on a blank image before the first request"""
+        self._configure_tensorflow()
+        from deepface import DeepFace
+        # build_model caches the model inside DeepFace; every later represent() call reuses it
+        DeepFace.build_model(settings.face_model_name)
+        DeepFace.represent(img_path=np.zeros((160, 160, 3), dtype=np.uint8), model_name=settings.face_model_name, enforce_detection=False)
+
     async def get_and_delete_folder_records(self, directory_name: str) -> List[str]:
         """Finds files in DB matching folder, deletes rows, returns S3 keys."""
         try:
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
-            search_pattern = f"%/{directory_name}/%"
-            
-            c.execute("SELECT s3_url FROM faces WHERE s3_url LIKE ?", (search_pattern,))
-            rows = c.fetchall()
-            
-            if not rows:
-                conn.close()
-                return []
-                
-            c.execute("DELETE FROM faces WHERE s3_url LIKE ?", (search_pattern,))
-            conn.commit()
-            conn.close()
+            urls = await asyncio.to_thread(self._delete_directory_rows, directory_name.strip("/"))
 
             s3_keys = []
-            for row in rows:
-                url = row[0]
-                if "amazonaws.com/" in url:
-                    key = url.split("amazonaws.com/")[-1]
+            for url in urls:
+                _, marker, key = url.rpartition("amazonaws.com/")
+                if marker and key:
                     s3_keys.append(key)
             return s3_keys
         except Exception as e:
-            logger.error(f"Failed to delete records: {str(e)}")
+            logger.error("Failed to delete records: %s", e)
             return []
 
+    def _matching_directories(self, c: sqlite3.Cursor, directory_name: str) -> List[str]:
+        """Stored directories selected by a folder filter (see directory_matches); reads only the directory index."""
+        c.execute("SELECT DISTINCT directory FROM faces WHERE directory IS NOT NULL")
+        return [row[0] for row in c.fetchall() if directory_matches(row[0], directory_name)]
+
+    def _delete_directory_rows(self, directory_name: str) -> List[str]:
+        """Delete every row of a folder and its subfolders, returns their S3 URLs (blocking)."""
+        with self._cursor() as c:
+            with self._conn:
+                # Take the write lock up front (SQLite's SELECT ... FOR UPDATE) so no other
+                # worker can add rows between the SELECT and the DELETE
+                c.execute("BEGIN IMMEDIATE")
+                rows = []
+                for directory in self._matching_directories(c, directory_name):
+                    c.execute("SELECT id, s3_url FROM faces WHERE directory = ?", (directory,))
+                    rows.extend(c.fetchall())
+                # Delete by primary key, no second lookup on directory
+                c.executemany("DELETE FROM faces WHERE id = ?", [(row_id,) for row_id, _ in rows])
+            urls = [s3_url for _, s3_url in rows]
+            if urls:
+                self._index.remove_urls(urls)
+            return urls
+
     async def list_files_in_directory(self, directory_name: str) -> List[Dict[str, str]]:
         try:
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
-            search_pattern = f"%/{directory_name}/%"
-            c.execute("SELECT image_path, s3_url, created_at FROM faces WHERE s3_url LIKE ?", (search_pattern,))
-            rows = c.fetchall()
-            conn.close()
+            rows = await asyncio.to_thread(self._list_directory_rows, directory_name.strip("/"))
 
             files = []
             for row in rows:
@@ -81,98 +219,194 @@ class FaceService:
         except Exception:
             return []
 
-    async def store_embedding(self, image_path: str, s3_url: str) -> bool:
+    def _list_directory_rows(self, directory_name: str) -> list:
+        """(image_path, s3_url, created_at) of every row of a folder and its subfolders (blocking)."""
+        with self._cursor() as c:
+            rows = []
+            for directory in self._matching_directories(c, directory_name):
+                c.execute("SELECT image_path, s3_url, created_at FROM faces WHERE directory = ? ORDER BY id", (directory,))
+                rows.extend(c.fetchall())
+            return rows
+
+    def embed_from_bytes(self, content: bytes) -> List[float]:
+        """Compute the face embedding of an encoded image (blocking, safe to run in a thread)."""
+        from deepface import DeepFace
+        img = self.decode_image_bytes(content)
+        embedding_objs = DeepFace.represent(img_path=img, model_name=settings.face_model_name, enforce_detection=False)
+        return embedding_objs[0]["embedding"]
+
+    async def store_embedding_record(self, s3_url: str, embedding) -> bool:
+        """Persist an already computed embedding for an uploaded S3 object."""
         try:
-            embedding_objs = DeepFace.represent(img_path=image_path, model_name=settings.face_model_name, enforce_detection=False)
-            embedding = embedding_objs[0]["embedding"]
-            embedding_bytes = np.array(embedding, dtype=np.float32).tobytes()
-
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
-            c.execute("INSERT OR REPLACE INTO faces (image_path, s3_url, embedding) VALUES (?, ?, ?)", (image_path, s3_url, embedding_bytes))
-            conn.commit()
-            conn.close()
+            # No file on disk, so the S3 key identifies the image
+            image_path = s3_key_of(s3_url)
+            await asyncio.to_thread(self._insert_embedding, image_path, s3_url, embedding)
             return True
         except Exception as e:
-            logger.error(f"Failed to store embedding: {str(e)}")
+            logger.error("Failed to store embedding: %s", e)
             return False
 
+    async def store_embedding_records(self, records: List[Tuple[str, List[float]]]) -> bool:
+        """Persist many (s3_url, embedding) pairs with a single executemany in one transaction."""
+        if not records:
+            return True
+        try:
+            rows = []
+            for s3_url, embedding in records:
+                embedding = np.array(embedding, dtype=np.float32)
+                image_path = s3_key_of(s3_url)
+                rows.append((
+                    image_path, s3_url, directory_of(s3_url),
+                    embedding.tobytes(), normalized_f16_bytes(embedding), quantize_i8(embedding).tobytes()
+                ))
+
+            await asyncio.to_thread(self._insert_embeddings, rows)
+            return True
+        except Exception as e:
+            logger.error("Failed to store embeddings: %s", e)
+            return False
+
+    def _insert_embeddings(self, rows: List[tuple]) -> None:
+        with self._cursor() as c:
+            with self._conn:
+                c.executemany(
+                    "INSERT OR REPLACE INTO faces (image_path, s3_url, directory, embedding, embedding_f16, embedding_i8) VALUES (?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+            # The search index picks these rows up through its next delta query
+            self._index_stale = True
+
+    def _insert_embedding(self, image_path: str, s3_url: str, embedding) -> None:
+        embedding = np.array(embedding, dtype=np.float32)
+        embedding_f16 = normalized_f16_bytes(embedding)
+        embedding_i8 = quantize_i8(embedding).tobytes()
+
+        with self._cursor() as c:
+            with self._conn:
+                c.execute(
+                    "INSERT OR REPLACE INTO faces (image_path, s3_url, directory, embedding, embedding_f16, embedding_i8) VALUES (?, ?, ?, ?, ?, ?)",
+                    (image_path, s3_url, directory_of(s3_url), embedding.tobytes(), embedding_f16, embedding_i8)
+                )
+            row_id = c.lastrowid
+            # Keep the search index current without waiting for the next delta query
+            if self._index.loaded:
+                blob = embedding_i8 if self._index_column == "embedding_i8" else embedding_f16
+                self._index.append(row_id, image_path, s3_url, directory_of(s3_url), np.frombuffer(blob, dtype=self._index.blob_dtype))
+
+    @contextmanager
+    def _cursor(self) -> Iterator[sqlite3.Cursor]:
+        """
+        Hold the lock and a cursor on the shared connection, closing the cursor on exit.
+        Writes add `with self._conn:` inside, which commits, or rolls back on error.
+        """
+        with self._lock, closing(self._conn.cursor()) as c:
+            yield c
+
+    def _fetchall(self, sql: str, params: tuple = ()) -> list:
+        """Run a read query on the shared connection (blocking, call through asyncio.to_thread)."""
+        with self._cursor() as c:
+            c.execute(sql, params)
+            return c.fetchall()
+
+    def decode_image_bytes(self, data: bytes) -> np.ndarray:
+        """Decode encoded image bytes into a BGR ndarray (the format DeepFace expects)."""
+        import cv2
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("Could not decode image")
+        return img
+
     async def get_all_faces(self) -> List[Tuple[str, str, bytes]]:
         try:
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
-            c.execute("SELECT image_path, s3_url, embedding FROM faces")
-            results = c.fetchall()
-            conn.close()
-            return results
+            return await asyncio.to_thread(self._fetchall, "SELECT image_path, s3_url, embedding FROM faces")
         except Exception:
             return []
 
     # --- UPDATED LOGIC HERE ---
-    async def search_similar_faces(self, query_image_path: str, directory_name: str | None, threshold: float = 0.40) -> List[Tuple[str, str, float]]:
+    async def search_similar_faces(self, query_image: str | np.ndarray, directory_name: str | None, threshold: float = 0.40) -> List[Tuple[str, str, float]]:
         """
         Search for similar faces.
+        - query_image: image path or decoded BGR ndarray (see decode_image_bytes).
         - If directory_name is provided: Search ONLY that folder.
         - If directory_name is None/Empty: Search EVERYTHING.
         """
         try:
             # 1. Generate Query Embedding
-            query_embedding_objs = DeepFace.represent(
-                img_path=query_image_path, 
+            from deepface import DeepFace
+            query_embedding_objs = await asyncio.to_thread(
+                DeepFace.represent,
+                img_path=query_image, 
                 model_name=settings.face_model_name,
                 enforce_detection=False
             )
             query_embedding = np.array(query_embedding_objs[0]["embedding"], dtype=np.float32)
+            query_norm = np.linalg.norm(query_embedding)
+            if query_norm:
+                query_embedding /= query_norm
+            if self._index.dtype == np.int8:
+                query_embedding = quantize_i8(query_embedding)
 
-            # 2. Prepare SQL
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
-            
-            if directory_name and directory_name.strip():
-                # Specific Folder Search
-                search_pattern = f"%/{directory_name}/%"
-                c.execute("SELECT image_path, s3_url, embedding FROM faces WHERE s3_url LIKE ?", (search_pattern,))
-            else:
-                # Global Search (No WHERE clause)
-                c.execute("SELECT image_path, s3_url, embedding FROM faces")
-            
-            stored_faces = c.fetchall()
-            conn.close()
-            
-            if not stored_faces:
+            # 2. Load (or reuse) the normalized embedding matrix
+            # Specific Folder Search, or Global Search when directory_name is empty
+            directory = directory_name.strip().strip("/") if directory_name else None
+            candidates = await asyncio.to_thread(self._search_candidates, directory, query_embedding.shape[0])
+            if candidates is None:
                 return []
+            matrix, rows, paths, urls = candidates
 
-            results = []
-            for image_path, s3_url, embedding_bytes in stored_faces:
-                try:
-                    db_embedding = np.frombuffer(embedding_bytes, dtype=np.float32)
-                    distance = cosine(query_embedding, db_embedding)
-                    
-                    if distance < threshold:
-                        results.append((image_path, s3_url, 1 - distance))
-                except Exception:
-                    continue
-
-            results.sort(key=lambda x: x[2], reverse=True)
-            return results
+            # 3. Cosine similarity against every candidate in one call (BLAS/SIMD release the GIL)
+            hit_rows, hit_sims = await asyncio.to_thread(rank_matches, matrix, rows, query_embedding, threshold)
+
+            return [(paths[r], urls[r], float(sim)) for r, sim in zip(hit_rows, hit_sims)]
             
         except Exception as e:
-            logger.error(f"Failed to search: {str(e)}")
+            logger.error("Failed to search: %s", e)
             raise HTTPException(status_code=500, detail=f"Face search failed: {str(e)}")
 
-    async def process_image_file(self, file_input: BinaryIO | bytes, file_extension: str) -> str:
-        try:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as tmp_file:
-                if isinstance(file_input, bytes):
-                    tmp_file.write(file_input)
-                else:
-                    shutil.copyfileobj(file_input, tmp_file)
-                return tmp_file.name
-        except Exception:
-            raise HTTPException(status_code=500, detail="Failed to process image file")
+    def _search_candidates(self, directory: str | None, dim: int):
+        """
+        Sync the index with the table and snapshot what a search needs (blocking).
+        Returns (matrix, rows, paths, urls), or None when there is nothing comparable to search.
+        """
+        with self._cursor() as c:
+            self._refresh_index(c)
+            index = self._index
+            if index.dim != dim:
+                return None
+            rows = index.candidate_rows(directory)
+            matrix = index.matrix[:index.size] if rows is None else index.matrix[rows]
+            return matrix, rows, index.paths, index.urls
+
+    def _refresh_index(self, c: sqlite3.Cursor) -> None:
+        """
+        Bring the in-memory index up to date with the table.
+        - New rows (id above the last seen id) are fetched and appended.
+        - If the live row count still disagrees (deletes/replaces by another worker), rebuild fully.
+        Skipped entirely (no table scan) when nobody has written since the last sync.
+        """
+        c.execute("PRAGMA data_version")
+        data_version = c.fetchone()[0]
+        index = self._index
+        if index.loaded and not self._index_stale and data_version == self._data_version:
+            return
+        self._data_version = data_version
+        self._index_stale = False
+
+        column = self._index_column
+        # Plain COUNT(*): the migrations fill the index column for every row
+        c.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM faces")
+        count, max_id = c.fetchone()
+
+        if index.loaded and max_id > index.max_id:
+            c.execute(
+                f"SELECT id, image_path, s3_url, directory, {column} FROM faces WHERE id > ? AND {column} IS NOT NULL ORDER BY id",
+                (index.max_id,)
+            )
+            for row_id, image_path, s3_url, directory, blob in c.fetchall():
+                index.append(row_id, image_path, s3_url, directory, np.frombuffer(blob, dtype=index.blob_dtype))
 
-    def cleanup_temp_file(self, file_path: str):
-        if os.path.exists(file_path):
-            os.unlink(file_path)
+        if not index.loaded or index.live_count + index.skipped != count or index.max_id != max_id:
+            c.execute(f"SELECT id, image_path, s3_url, directory, {column} FROM faces WHERE {column} IS NOT NULL ORDER BY id")
+            index.load(c.fetchall())
 
 face_service = FaceService()
\ No newline at end of file
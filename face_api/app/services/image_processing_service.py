@@ -1,19 +1,42 @@
 from PIL import Image
 import io
+import math
 import logging
 from typing import BinaryIO
 
 logger = logging.getLogger(__name__)
 
+# Quality used for the pilot encode, and the highest quality ever used
+PILOT_QUALITY = 80
+MAX_QUALITY = 90
+# Last resort once the canvas is down to its 600px floor
+MIN_QUALITY = 30
+# Below this quality, shrink the canvas instead
+# (Better to have a sharp small image than a blurry large one)
+RESIZE_BELOW_QUALITY = 70
+# Longest side kept by compression (Full HD)
+MAX_DIMENSION = 1920
+
 class ImageProcessingService:
     def __init__(self):
         # HARD LIMIT: 500KB
         self.MAX_SIZE_BYTES = 500 * 1024  
 
-    def process_image(self, base_image_file: BinaryIO, watermark_bytes: bytes | None = None) -> bytes:
+    def process_image(self, base_image_file: BinaryIO | bytes, watermark_bytes: bytes | None = None) -> bytes:
+        if isinstance(base_image_file, bytes):
+            base_image_file = io.BytesIO(base_image_file)
         try:
             # 1. Load
-            base_img = Image.open(base_image_file).convert("RGBA")
+            # Large JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale, as long as the
+            # result still covers the 1920px thumbnail compression makes anyway.
+            # The target keeps the aspect ratio, otherwise the short side blocks any scaling.
+            # Other formats ignore draft()
+            base_img = Image.open(base_image_file)
+            width, height = base_img.size
+            scale = MAX_DIMENSION / max(width, height)
+            if scale < 1:
+                base_img.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+            base_img = base_img.convert("RGBA")
 
             # 2. Watermark
             if watermark_bytes:
@@ -27,7 +50,7 @@ class ImageProcessingService:
             return self._compress_to_target_size(final_img_rgb)
 
         except Exception as e:
-            logger.error(f"Error processing image: {str(e)}")
+            logger.error("Error processing image: %s", e)
             base_image_file.seek(0)
             return base_image_file.read()
 
@@ -41,68 +64,74 @@ class ImageProcessingService:
         position_x = base_img.width - target_width - padding
         position_y = base_img.height - target_height - padding
         
-        transparent_layer = Image.new('RGBA', base_img.size, (0, 0, 0, 0))
-        transparent_layer.paste(watermark_resized, (position_x, position_y), watermark_resized)
-        return Image.alpha_composite(base_img, transparent_layer)
+        # Composite only the watermark's box instead of a full-size transparent layer
+        box = (position_x, position_y, position_x + target_width, position_y + target_height)
+        region = Image.alpha_composite(base_img.crop(box), watermark_resized)
+        base_img.paste(region, box[:2])
+        return base_img
 
     def _compress_to_target_size(self, img: Image.Image) -> bytes:
         """
         Guarantees < 500KB using strict resizing + quality reduction.
         """
-        img_byte_arr = io.BytesIO()
-        
         # STEP 1: Initial Sanity Resize
         # If image is massive (e.g. 4000px), immediately drop to 1920px (Full HD).
         # A 4000px image will almost NEVER be < 500KB unless quality is destroyed.
-        if img.width > 1920 or img.height > 1920:
-            logger.info(f"Image too big ({img.width}x{img.height}). Resizing to max 1920px.")
-            img.thumbnail((1920, 1920), Image.Resampling.LANCZOS)
+        if img.width > MAX_DIMENSION or img.height > MAX_DIMENSION:
+            logger.info("Image too big (%sx%s). Resizing to max %spx.", img.width, img.height, MAX_DIMENSION)
+            img.thumbnail((MAX_DIMENSION, MAX_DIMENSION), Image.Resampling.LANCZOS)
 
-        quality = 90
-        iteration = 0
-        
-        while True:
-            img_byte_arr.seek(0)
-            img_byte_arr.truncate()
-            
-            # Save
-            img.save(img_byte_arr, format='JPEG', quality=quality, optimize=True)
-            size = img_byte_arr.tell()
-            
-            # Success Check
+        # STEP 2: One pilot encode (no Huffman optimization pass), then solve the
+        # size model size ~ q^1.2 for the quality that lands on the budget.
+        # Only qualities >= RESIZE_BELOW_QUALITY are tried at this size
+        size0 = len(self._encode(img, PILOT_QUALITY, optimize=False))
+        quality = self._solve_quality(PILOT_QUALITY, size0)
+        # Last measured size and the quality it was measured at
+        size, measured_quality = size0, PILOT_QUALITY
+        if quality >= RESIZE_BELOW_QUALITY:
+            data = self._encode(img, quality)
+            size, measured_quality = len(data), quality
+            if size > self.MAX_SIZE_BYTES:
+                # One correction from the measured size when the model overshot
+                quality = self._solve_quality(quality, size)
+                if quality >= RESIZE_BELOW_QUALITY:
+                    data = self._encode(img, quality)
+                    size, measured_quality = len(data), quality
             if size <= self.MAX_SIZE_BYTES:
-                logger.info(f"Compression success: {size/1024:.2f}KB | Quality: {quality} | Size: {img.width}x{img.height}")
-                img_byte_arr.seek(0)
-                return img_byte_arr.read()
-            
-            # Failure Handling
-            iteration += 1
-            if iteration > 15: # Safety break to prevent infinite loops
-                break
+                logger.info("Compression success: %.2fKB | Quality: %s | Size: %sx%s", size/1024, quality, img.width, img.height)
+                return data
 
-            # STRATEGY:
-            # 1. If quality is good (>70), just lower quality.
-            # 2. If quality gets too low (<=70), RESIZE the image smaller.
-            #    (Better to have a sharp small image than a blurry large one)
-            if quality > 70:
-                quality -= 10
+        # STEP 3: Fitting would need quality below RESIZE_BELOW_QUALITY: shrink the canvas instead.
+        # Size scales with pixel count, so scale both sides by sqrt(budget / size),
+        # with size estimated at the resize quality
+        quality = RESIZE_BELOW_QUALITY
+        size = size * (quality / measured_quality) ** 1.2
+        for _ in range(3):
+            scale = (self.MAX_SIZE_BYTES / size) ** 0.5
+            new_width = max(600, int(img.width * scale))
+            if new_width >= img.width:
+                # Already as small as we allow (600px), fall back to the lowest quality
+                quality = MIN_QUALITY
             else:
-                # Drastic Resize: Reduce dimensions by 25%
-                new_width = int(img.width * 0.75)
-                new_height = int(img.height * 0.75)
-                
-                # Don't go absurdly small
-                if new_width < 600: 
-                    # If we are tiny and still > 500KB (unlikely), force low quality
-                    quality = 50 
-                else:
-                    logger.info(f"Resizing further to {new_width}x{new_height}...")
-                    img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                    # Reset quality to 85 because we have a new, smaller canvas
-                    quality = 85
-
-        # Final return if loop breaks
-        img_byte_arr.seek(0)
-        return img_byte_arr.read()
+                new_height = max(1, int(img.height * new_width / img.width))
+                logger.info("Resizing further to %sx%s...", new_width, new_height)
+                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+            data = self._encode(img, quality)
+            size = len(data)
+            if size <= self.MAX_SIZE_BYTES:
+                logger.info("Compression success: %.2fKB | Quality: %s | Size: %sx%s", size/1024, quality, img.width, img.height)
+                break
+        return data
+
+    def _solve_quality(self, quality: int, size: int) -> int:
+        """Quality expected to hit the size budget, given `size` measured at `quality` (capped at MAX_QUALITY)."""
+        return min(MAX_QUALITY, int(quality * (self.MAX_SIZE_BYTES / size) ** (1 / 1.2)))
+
+    def _encode(self, img: Image.Image, quality: int, optimize: bool = True) -> bytes:
+        # 4:2:0 chroma subsampling always (so the pilot predicts the final size);
+        # progressive scans are smaller still but cost an extra pass, so only on real encodes
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=quality, optimize=optimize, progressive=optimize, subsampling=2)
+        return buffer.getvalue()
 
 image_processing_service = ImageProcessingService()
\ No newline at end of file
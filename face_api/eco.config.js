@@ -1,10 +1,18 @@
+const os = require("os");
+
+// Uvicorn workers; exported to the app too so each worker sizes its image process pool
+const workers = process.env.WEB_CONCURRENCY || String(os.cpus().length);
+
 module.exports = {
     apps: [
         {
             name: "face-fastapi-app",
             script: "uvicorn",
-            args: ["app.main:app", "--host", "0.0.0.0", "--port", "8009"],
-            interpreter: "python3"
+            args: ["app.main:app", "--host", "0.0.0.0", "--port", "8009", "--workers", workers, "--loop", "uvloop", "--http", "httptools"],
+            interpreter: "python3",
+            env: {
+                WEB_CONCURRENCY: workers
+            }
         }
     ]
 };